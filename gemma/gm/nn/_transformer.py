@@ -59,7 +59,7 @@ class Output:
 
   # When `return_last_only`, `logits` is `*B V`
   logits: Float['*B L V'] | Float['*B V']
-  cache: transformer.Cache | None
+  cache: transformer.Cache | transformer.StackedCache | None
   hidden_states: Float['*B L D'] | Float['*B D'] | None
 
 
@@ -137,7 +137,7 @@ class Transformer(transformer.Transformer):
       # TODO(epot): Cleanup and simplify the API.
       positions: Int['*B L'] | None = None,
       positions_offset: Int['*B'] | None = None,
-      cache: transformer.Cache | None = None,
+      cache: transformer.Cache | transformer.StackedCache | None = None,
       # During training and pre-filling, the attention mask is `*B L L`
       # When sampling (after prefilling), tokens are decoded one by one,
       # so the attention mask is `*B 1 cache_length`
@@ -199,8 +199,17 @@ class Transformer(transformer.Transformer):
       x = inputs.embeddings
 
       old_cache = cache or {}
-      new_cache = {}
+      new_cache = cache if self.config.use_stacked_cache else {}
       for i, block in enumerate(self.blocks):
+        if self.config.use_stacked_cache:
+          # Each block updates its own slice of the stacked cache.
+          new_cache, x = block(
+              x,
+              inputs.positions,
+              new_cache,
+              inputs.attention_mask,
+          )
+          continue
         layer_name = f'layer_{i}'
         layer_cache, x = block(
             x,
@@ -244,7 +253,7 @@ class Transformer(transformer.Transformer):
       batch_size: int,
       dtype: jnp.dtype[Any],
       cache_length: int,
-  ) -> transformer.Cache:
+  ) -> transformer.Cache | transformer.StackedCache:
     return self.config.init_cache(
         batch_size=batch_size,
         dtype=dtype,
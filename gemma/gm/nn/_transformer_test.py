@@ -0,0 +1,82 @@
+# Copyright 2024 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dataclasses
+
+from gemma import gm
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+
+def _assert_logits_close(logits, expected_logits):
+  np.testing.assert_allclose(
+      logits.astype(jnp.float32),
+      expected_logits.astype(jnp.float32),
+      rtol=1e-2,
+      atol=1e-2,
+  )
+
+
+def test_dot_product_attention():
+  model = gm.testing.DummyGemma()
+  fused_model = gm.testing.DummyGemma(
+      config=dataclasses.replace(model.config, use_dot_product_attention=True)
+  )
+  tokens = jnp.array([[1, 2, 3, 4], [5, 6, 7, 0]])
+  params = model.init(jax.random.PRNGKey(0), tokens)
+
+  out = model.apply(params, tokens)
+  fused_out = fused_model.apply(params, tokens)
+  _assert_logits_close(fused_out.logits, out.logits)
+
+  # The float32 cache dtype differs from the (bfloat16) model `dtype`.
+  cache = model.init_cache(
+      batch_size=2, dtype=jnp.float32, cache_length=tokens.shape[-1]
+  )
+  out = model.apply(params, tokens, cache=cache)
+  fused_out = fused_model.apply(params, tokens, cache=cache)
+  _assert_logits_close(fused_out.logits, out.logits)
+
+
+def test_stacked_cache():
+  config = dataclasses.replace(
+      gm.testing.DummyGemma.config,
+      num_layers=2,
+      attention_types=(gm.nn.config.AttentionType.GLOBAL,) * 2,
+  )
+  model = gm.testing.DummyGemma(config=config)
+  stacked_model = gm.testing.DummyGemma(
+      config=dataclasses.replace(config, use_stacked_cache=True)
+  )
+  tokens = jnp.array([[1, 2, 3, 4], [5, 6, 7, 0], [8, 9, 0, 0]])
+  params = model.init(jax.random.PRNGKey(0), tokens)
+
+  stacked_cache = stacked_model.init_cache(
+      batch_size=3, dtype=jnp.float32, cache_length=tokens.shape[-1]
+  )
+  assert stacked_cache['k'].shape == (3, 2, 4, 2, 128)
+  assert stacked_cache['end_index'].shape == (3, 2)
+
+  cache = model.init_cache(
+      batch_size=3, dtype=jnp.float32, cache_length=tokens.shape[-1]
+  )
+  out = model.apply(params, tokens, cache=cache)
+  stacked_out = stacked_model.apply(params, tokens, cache=stacked_cache)
+
+  np.testing.assert_array_equal(stacked_out.logits, out.logits)
+  for i in range(config.num_layers):
+    for name, value in out.cache[f'layer_{i}'].items():
+      np.testing.assert_array_equal(stacked_out.cache[name][:, i], value)
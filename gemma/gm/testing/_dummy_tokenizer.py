@@ -72,7 +72,9 @@ class _DummySentencePieceProcessor(*_base_cls):
     reverse_mapping = {v: k for k, v in self._mapping_text_to_id.items()}
     return ' '.join(reverse_mapping[e] for e in ids)
 
-  def EncodeAsIds(self, text: str) -> list[int]:  # pylint: disable=invalid-name
+  def EncodeAsIds(self, text: str | list[str]) -> list[int] | list[list[int]]:  # pylint: disable=invalid-name
+    if isinstance(text, list):  # Batched input, like `spm`
+      return [self.EncodeAsIds(t) for t in text]
     words = text.split(' ')
     return [self._mapping_text_to_id[word] for word in words]
 
@@ -363,7 +363,7 @@ class Sampler:
   ) -> tuple[Float['B L'], bool]:
     """Encode the prompts."""
     prompt, is_single_prompt = _normalize_prompt(prompt)
-    tokens = [self.tokenizer.encode(p, add_bos=add_bos) for p in prompt]
+    tokens = self.tokenizer.encode_batch(prompt, add_bos=add_bos)
 
     max_prompt_len = max(len(t) for t in tokens)
 
@@ -73,7 +73,7 @@ class SamplingState:
   # TODO(epot): Only keep the top-k logits instead? But sorting might increase
   # computation.
   # predicted_logits: Float['B max_out_length V']
-  cache: transformer.Cache
+  cache: transformer.Cache | transformer.StackedCache
   rng: PRNGKey
 
   # Static values (i.e. do not changes between steps)
@@ -119,7 +119,7 @@ class SamplerCall:
       params: params_lib.Params,
       tokens: Int['B L'],
       images: UInt8['B N H W C'] | None,
-      cache: transformer.Cache,
+      cache: transformer.Cache | transformer.StackedCache,
       last_state: SamplingState | None,
       max_new_tokens: Int[''],
       init_cache_length: int,
@@ -139,9 +139,12 @@ class SamplerCall:
     )
 
     # Sample autoregressively.
+    # The cache is passed (and donated) separately, so XLA can update the kv
+    # buffers in-place rather than allocating a second copy of the cache.
     state = self._sample_loop(
         params=params,
-        state=init_state,
+        state=dataclasses.replace(init_state, cache={}),
+        cache=init_state.cache,
         max_new_tokens=max_new_tokens,
     )
 
@@ -159,7 +162,7 @@ class SamplerCall:
       self,
       *,
       params: params_lib.Params,
-      cache: transformer.Cache,
+      cache: transformer.Cache | transformer.StackedCache,
       tokens: Int['B L'],
       images: UInt8['B N H W C'] | None,
       last_state: SamplingState | None,
@@ -242,15 +245,32 @@ class SamplerCall:
         init_cache_length=jnp.asarray(init_cache_length),
     )
 
-  @functools.partial(jax.jit, static_argnames=('self',))
+  @functools.partial(
+      jax.jit,
+      static_argnames=('self',),
+      donate_argnames=('cache',),
+  )
   def _sample_loop(
       self,
       *,
       params: params_lib.Params,
       state: SamplingState,
+      cache: transformer.Cache | transformer.StackedCache,
       max_new_tokens: Int[''],
   ) -> SamplingState:
-    """Internal sampling function (to be jitted)."""
+    """Internal sampling function (to be jitted).
+
+    Args:
+      params: Model params.
+      state: Initial sampling state, without the cache.
+      cache: The kv cache of the initial state. It is donated, so should not be
+        used after this call (`_init_state` always returns a new cache).
+      max_new_tokens: Maximum number of tokens to sample.
+
+    Returns:
+      The final sampling state.
+    """
+    state = dataclasses.replace(state, cache=cache)
 
     step_fn = functools.partial(self._sample_step, params=params)
 
@@ -417,20 +437,57 @@ def _get_last_token(tokens: Int['B L']) -> Int['B']:
   return x
 
 
+# Cache entries indexed by the cache position (`[B, cache_length, ...]`). The
+# `*_scale` entries are only present for quantized (int8) caches.
+_CACHE_SEQUENCE_KEYS = ('k', 'v', 'k_scale', 'v_scale')
+
+
+def _is_stacked_cache(cache) -> bool:
+  """Returns whether the cache is stacked across layers.
+
+  See `TransformerConfig.use_stacked_cache`. A stacked cache is a single
+  `LayerCache` with a `num_layers` axis after the batch axis.
+
+  Args:
+    cache: Per-layer or stacked cache.
+  """
+  return 'end_index' in cache
+
+
+def _slice_layer_cache(layer_data, *, seq_axis: int, length: int):
+  seq_slice = (slice(None),) * seq_axis + (slice(None, length),)
+  new_data = dict(layer_data)
+  for name in _CACHE_SEQUENCE_KEYS:
+    if name in layer_data:
+      new_data[name] = layer_data[name][seq_slice]
+  return new_data
+
+
 def _slice_cache(cache, *, length: int):
-  new_cache = {}
-  for k, layer_data in cache.items():
-    new_data = dict(layer_data)
-    new_data['k'] = layer_data['k'][:, :length, :, :]
-    new_data['v'] = layer_data['v'][:, :length, :, :]
-    new_cache[k] = new_data
-  return new_cache
+  if _is_stacked_cache(cache):
+    return _slice_layer_cache(cache, seq_axis=2, length=length)
+  return {
+      k: _slice_layer_cache(layer_data, seq_axis=1, length=length)
+      for k, layer_data in cache.items()
+  }
+
+
+def _merge_layer_cache(old_data, new_data, *, seq_axis: int, length: int):
+  seq_slice = (slice(None),) * seq_axis + (slice(None, length),)
+  updated_data = dict(new_data)
+  # The `_sample_loop` will re-start from the last prompt token, so use `-1`
+  # as the first token is re-computed.
+  updated_data['end_index'] = new_data['end_index'] - 1
+  for name in _CACHE_SEQUENCE_KEYS:
+    if name in old_data:
+      updated_data[name] = old_data[name].at[seq_slice].set(new_data[name])
+  return updated_data
 
 
 def _merge_cache(
     *,
-    old_cache: transformer.Cache,
-    new_cache: transformer.Cache,
+    old_cache: transformer.Cache | transformer.StackedCache,
+    new_cache: transformer.Cache | transformer.StackedCache,
     length: int,
 ):
   """Merges a new cache into an existing cache, updating 'k' and 'v' arrays.
@@ -444,19 +501,12 @@ def _merge_cache(
   Returns:
       The updated (merged) cache dictionary.
   """
-  updated_cache = jax.tree.map(lambda x: x, new_cache)  # Deep-copy
-
-  for k, (old_data, new_data) in epy.zip_dict(old_cache, new_cache):
-    # The `_sample_loop` will re-start from the last prompt token, so use `-1`
-    # as the first token is re-computed.
-    updated_cache[k]['end_index'] = new_data['end_index'] - 1
-    updated_cache[k]['k'] = (
-        old_data['k'].at[:, :length, :, :].set(new_data['k'])
-    )
-    updated_cache[k]['v'] = (
-        old_data['v'].at[:, :length, :, :].set(new_data['v'])
-    )
-  return updated_cache
+  if _is_stacked_cache(old_cache):
+    return _merge_layer_cache(old_cache, new_cache, seq_axis=2, length=length)
+  return {
+      k: _merge_layer_cache(old_data, new_data, seq_axis=1, length=length)
+      for k, (old_data, new_data) in epy.zip_dict(old_cache, new_cache)
+  }
 
 
 @typechecked
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import dataclasses
+
 from gemma import gm
 from gemma.gm.text import _sampler_call
 import jax
@@ -70,6 +72,67 @@ def test_sampler():
   sampler.sample('Hello world')
 
 
+def test_sampler_max_new_tokens():
+  model = gm.testing.DummyGemma()
+  params = model.init(
+      jax.random.PRNGKey(0),
+      jnp.zeros((5,), dtype=jnp.int32),
+  )
+  params = params['params']
+  tokenizer = gm.testing.DummyTokenizer()
+
+  sampler = gm.text.Sampler(
+      model=model,
+      params=params,
+      tokenizer=tokenizer,
+      cache_length=128,
+      max_out_length=128,
+  )
+  # `max_new_tokens` is a dynamic bound of the jitted `lax.while_loop`, so
+  # changing it does not trigger a re-compilation (unlike a `lax.scan`).
+  num_compilations = []
+  for max_new_tokens in (1, 3, 5):
+    out = sampler.sample(
+        'Hello world', max_new_tokens=max_new_tokens, return_state=True
+    )
+    assert int(out.state.step) == max_new_tokens
+    num_compilations.append(
+        _sampler_call.SamplerCall._sample_loop._cache_size()
+    )
+  assert len(set(num_compilations)) == 1
+
+
+def test_sampler_stacked_cache():
+  model = gm.testing.DummyGemma()
+  stacked_model = gm.testing.DummyGemma(
+      config=dataclasses.replace(model.config, use_stacked_cache=True)
+  )
+  params = model.init(
+      jax.random.PRNGKey(0),
+      jnp.zeros((5,), dtype=jnp.int32),
+  )
+  params = params['params']
+  tokenizer = gm.testing.DummyTokenizer()
+
+  outputs = []
+  for m in (model, stacked_model):
+    sampler = gm.text.Sampler(
+        model=m,
+        params=params,
+        tokenizer=tokenizer,
+        cache_length=128,
+        max_out_length=128,
+    )
+    outputs.append(
+        sampler.sample('Hello world', max_new_tokens=5, return_state=True)
+    )
+  out, stacked_out = outputs
+  assert stacked_out.text == out.text
+  np.testing.assert_array_equal(
+      stacked_out.state.predicted_tokens, out.state.predicted_tokens
+  )
+
+
 # TODO(epot):
 # def test_slice_cache():
 #   _sampler_call._slice_cache(cache=)
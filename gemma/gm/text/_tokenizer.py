@@ -22,12 +22,9 @@ import functools
 import typing
 from typing import ClassVar
 
-import einops
 from etils import enp
 from etils import epath
 from etils import epy
-import jax
-import jax.numpy as jnp
 from kauldron.utils import immutabledict
 import numpy as np
 
@@ -35,6 +32,11 @@ from sentencepiece import sentencepiece_model_pb2
 import sentencepiece as spm
 
 with epy.lazy_imports():
+  # Only required by `plot_logits`, so encoding / decoding text does not need
+  # to import them.
+  import einops  # pylint: disable=g-import-not-at-top
+  import jax  # pylint: disable=g-import-not-at-top
+  import jax.numpy as jnp  # pylint: disable=g-import-not-at-top
   from plotly import graph_objects as go  # pylint: disable=g-import-not-at-top  # pytype: disable=import-error
   import plotly.express as px  # pylint: disable=g-import-not-at-top  # pytype: disable=import-error
 
@@ -210,6 +212,37 @@ class Tokenizer:
       token_ids.append(self.special_tokens.EOS)
     return token_ids
 
+  def encode_batch(
+      self,
+      texts: list[str],
+      *,
+      add_bos: bool = False,
+      add_eos: bool = False,
+  ) -> list[list[int]]:
+    """Encode a batch of texts into lists of token ids.
+
+    ```python
+    tokenizer = gm.text.Gemma2Tokenizer()
+    tokenizer.encode_batch(['Hello world!', 'How are you?'])
+    ```
+
+    Unlike calling `encode` on each text, the whole batch is encoded in a
+    single SentencePiece call, which runs the loop in C++ across multiple
+    threads rather than in Python.
+
+    Args:
+      texts: The texts to encode.
+      add_bos: Whether to prepend the BOS token (`2`) (begin of sentence).
+      add_eos: Whether to append the EOS token (`1`) (end of sentence).
+
+    Returns:
+      The list of token ids, for each text.
+    """
+    batch_token_ids = self._sp.EncodeAsIds(list(texts))
+    prefix = [self.special_tokens.BOS] if add_bos else []
+    suffix = [self.special_tokens.EOS] if add_eos else []
+    return [prefix + token_ids + suffix for token_ids in batch_token_ids]
+
   def decode(self, ids: int | list[int] | enp.typing.Array) -> str:
     if isinstance(ids, int):
       ids = [ids]
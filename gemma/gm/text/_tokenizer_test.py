@@ -25,3 +25,13 @@ def test_pickle():
   tokenizer.encode('Hello world!')  # Trigger the lazy-loading of the tokenizer.
 
   pickle.dumps(tokenizer)
+
+
+def test_encode_batch():
+  tokenizer = gm.testing.DummyTokenizer()
+
+  texts = ['hello world', 'My name is Morgane']
+  assert tokenizer.encode_batch(texts) == [tokenizer.encode(t) for t in texts]
+  assert tokenizer.encode_batch(texts, add_bos=True, add_eos=True) == [
+      tokenizer.encode(t, add_bos=True, add_eos=True) for t in texts
+  ]
@@ -19,6 +19,24 @@ import jax
 import jax.numpy as jnp
 
 
+def einsum(
+    eqn: str,
+    x: jax.Array,
+    y: jax.Array,
+    *,
+    compute_dtype: jnp.dtype | None = None,
+) -> jax.Array:
+  """`jnp.einsum`, eventually computed in `compute_dtype` (see `Einsum`)."""
+  if compute_dtype is None:
+    return jnp.einsum(eqn, x, y)
+  return jnp.einsum(
+      eqn,
+      x.astype(compute_dtype),
+      y.astype(compute_dtype),
+      preferred_element_type=jnp.float32,
+  )
+
+
 class Einsum(nn.Module):
   """Einsum is a convenience module for parameterized tensor multiplication."""
 
@@ -26,6 +44,9 @@ class Einsum(nn.Module):
   weight_name: str = 'w'
   initializer: nn.initializers.Initializer = nn.initializers.normal()
   dtype: jnp.dtype | None = None
+  # If set, the inputs and weights are cast to `compute_dtype` (e.g. bfloat16)
+  # for the einsum, which still accumulates and returns in float32.
+  compute_dtype: jnp.dtype | None = None
 
   @nn.compact
   def __call__(self, eqn: str, x: jax.Array) -> jax.Array:
@@ -35,7 +56,7 @@ class Einsum(nn.Module):
         self.shape,
         self.dtype if self.dtype is not None else None,
     )
-    return jnp.einsum(eqn, x, w)
+    return einsum(eqn, x, w, compute_dtype=self.compute_dtype)
 
 
 class RMSNorm(nn.Module):
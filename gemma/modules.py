@@ -59,11 +59,42 @@ def _create_sliding_mask(
   return sliding_mask
 
 
+def _quantize_int8(x: jax.Array, axis: int) -> tuple[jax.Array, jax.Array]:
+  """Symmetric int8 quantization, with one float32 scale along `axis`."""
+  x = x.astype(jnp.float32)
+  scale = jnp.max(jnp.abs(x), axis=axis, keepdims=True) / 127
+  x = jnp.round(x / jnp.where(scale == 0, 1.0, scale))
+  return x.astype(jnp.int8), scale
+
+
+def _kv_scale_to_logits(
+    scale: jax.Array, kv_spec: str, *, grouped: bool
+) -> jax.Array:
+  """Reshapes an int8 cache scale to broadcast against the attention logits."""
+  scale = jnp.squeeze(scale, axis=kv_spec.index('H'))
+  if kv_spec.index('S') < kv_spec.index('K'):
+    scale = jnp.swapaxes(scale, 1, 2)  # [B, S, K] -> [B, K, S]
+  if grouped:
+    return scale[:, None, :, None, :]  # [B, 1, K, 1, S]
+  return scale[:, None, :, :]  # [B, 1, K, S]
+
+
 class AttentionType(enum.Enum):
   GLOBAL = 1
   LOCAL_SLIDING = 2
 
 
+class KVLayout(enum.Enum):
+  """Memory layout of the `k` / `v` arrays of the attention cache."""
+
+  # [batch_size, cache_size, num_kv_heads, head_dim]
+  BTHD = 1
+  # [batch_size, num_kv_heads, head_dim, cache_size]
+  # The cache axis is the innermost one, so the decode-time qk product reads
+  # the cache contiguously along its contracting dimension.
+  BHDT = 2
+
+
 class Embedder(nn.Module):
   """Embedder module."""
 
@@ -119,6 +150,18 @@ class Attention(nn.Module):
   attn_logits_soft_cap: float | None = None
   sliding_window_size: int | None = None
   use_qk_norm: bool = False
+  kv_layout: KVLayout = KVLayout.BTHD
+  # If `True`, uses the fused `jax.nn.dot_product_attention` kernel (which
+  # does not materialize the attention logits) instead of explicit einsums.
+  # The kernel expects `BSKH` keys and values, so a cache with
+  # `KVLayout.BHDT` is not supported.
+  use_dot_product_attention: bool = False
+  # If set (e.g. `jnp.bfloat16`), the einsums inputs and weights are cast to
+  # `activation_dtype`, while accumulating in float32.
+  activation_dtype: jnp.dtype | None = None
+  # If set, the cache is stacked across layers (with the layer axis after the
+  # batch axis), and only the `layer_idx` slice of it is read and written.
+  layer_idx: int | None = None
 
   @property
   def use_qkv_einsum(self):
@@ -131,18 +174,22 @@ class Attention(nn.Module):
   def setup(self):
     self.attn_vec_einsum = layers.Einsum(
         shape=(self.num_heads, self.head_dim, self.features),
+        compute_dtype=self.activation_dtype,
     )
 
     if self.use_qkv_einsum:
       self.qkv_einsum = layers.Einsum(
           shape=(3, self.num_heads, self.features, self.head_dim),
+          compute_dtype=self.activation_dtype,
       )
     else:
       self.q_einsum = layers.Einsum(
           shape=(self.num_heads, self.features, self.head_dim),
+          compute_dtype=self.activation_dtype,
       )
       self.kv_einsum = layers.Einsum(
           shape=(2, self.num_kv_heads, self.features, self.head_dim),
+          compute_dtype=self.activation_dtype,
       )
     if self.use_qk_norm:
       self._query_norm = layers.RMSNorm()
@@ -153,8 +200,20 @@ class Attention(nn.Module):
       x: jax.Array,
       segment_pos: jax.Array,
       cache: LayerCache | None,
-      attn_mask: jax.Array,
+      attn_mask: jax.Array | None = None,
   ) -> tuple[LayerCache | None, jax.Array]:
+    """Attention forward pass.
+
+    Args:
+      x: Input sequence `[B, T, D]`.
+      segment_pos: Input absolute positions `[B, T]`.
+      cache: KV cache or None.
+      attn_mask: Attention mask `[B, T, S]`. If `None`, all the keys are
+        attended to, and the masking is skipped entirely.
+
+    Returns:
+      The new cache (or None) and the attention output.
+    """
     seq_len = x.shape[1]
 
     if self.use_qkv_einsum:
@@ -181,75 +240,222 @@ class Attention(nn.Module):
         scale_factor=self.rope_scale_factor,
     )
 
+    # Einsum spec of the key / value arrays. Only the cache uses `kv_layout`,
+    # the `[B, S, K, H]` projections are used directly otherwise.
+    if cache is not None and self.kv_layout == KVLayout.BHDT:
+      kv_spec = 'BKHS'
+      key_proj = jnp.transpose(key_proj, (0, 2, 3, 1))
+      value_proj = jnp.transpose(value_proj, (0, 2, 3, 1))
+    else:
+      kv_spec = 'BSKH'
+
     # Cache is left aligned.
     # Save the KV values to the cache.
     if cache is not None:
-      end_index = cache['end_index'][0]
-      slice_indices = (0, end_index % cache['v'].shape[1], 0, 0)
-      value_proj = jax.lax.dynamic_update_slice(
-          cache['v'],
+      time_axis = kv_spec.index('S')
+      if self.layer_idx is None:
+        end_index = cache['end_index'][0]
+        cache_size = cache['v'].shape[time_axis]
+      else:
+        end_index = cache['end_index'][0, self.layer_idx]
+        cache_size = cache['v'].shape[time_axis + 1]
+      slice_indices = [0, 0, 0, 0]
+      slice_indices[time_axis] = end_index % cache_size
+      is_quantized = 'k_scale' in cache
+      if is_quantized:
+        head_dim_axis = kv_spec.index('H')
+        k, k_scale = _quantize_int8(key_proj, axis=head_dim_axis)
+        v, v_scale = _quantize_int8(value_proj, axis=head_dim_axis)
+        updates = {'k': k, 'k_scale': k_scale, 'v': v, 'v_scale': v_scale}
+      else:
+        updates = {'k': key_proj, 'v': value_proj}
+      if self.layer_idx is not None:
+        # Only the new tokens are written into the shared buffers.
+        slice_indices.insert(1, self.layer_idx)
+        updates = {name: value[:, None] for name, value in updates.items()}
+      new_cache = {
+          name: jax.lax.dynamic_update_slice(
+              cache[name], value.astype(cache[name].dtype), slice_indices
+          )
+          for name, value in updates.items()
+      }
+      if self.layer_idx is None:
+        new_cache['end_index'] = cache['end_index'] + seq_len
+        layer_cache = new_cache
+      else:
+        new_cache['end_index'] = (
+            cache['end_index'].at[:, self.layer_idx].add(seq_len)
+        )
+        layer_cache = jax.tree.map(lambda x: x[:, self.layer_idx], new_cache)
+
+      key_proj = layer_cache['k']
+      value_proj = layer_cache['v']
+      # The int8 values are used as-is, and the scales are applied inside
+      # `_attend`.
+      k_scale = layer_cache.get('k_scale')
+      v_scale = layer_cache.get('v_scale')
+    else:
+      end_index = 0
+      new_cache = None
+      k_scale = v_scale = None
+
+    if self.attn_type == AttentionType.LOCAL_SLIDING:
+      if self.sliding_window_size is None:
+        raise ValueError(
+            'Sliding_window_size must be set if Local Sliding attention type'
+        )
+      sliding_mask = _create_sliding_mask(
+          segment_pos,
+          end_index=end_index,
+          # Derive cache length from attn_mask shape in case cache is None
+          cache_len=attn_mask.shape[-1]
+          if attn_mask is not None
+          else key_proj.shape[kv_spec.index('S')],
+          sliding_window_size=self.sliding_window_size,
+      )
+      if attn_mask is None:
+        attn_mask = sliding_mask
+      else:
+        attn_mask *= sliding_mask
+
+    if self.use_dot_product_attention:
+      if self.attn_logits_soft_cap is not None:
+        raise ValueError(
+            '`use_dot_product_attention` does not support'
+            ' `attn_logits_soft_cap`.'
+        )
+      if k_scale is not None:
+        raise ValueError(
+            '`use_dot_product_attention` does not support an int8 cache.'
+        )
+      if kv_spec != 'BSKH':
+        # The `BHDT` cache would have to be transposed back to `BSKH` on every
+        # call, which defeats the purpose of the layout.
+        raise ValueError(
+            '`use_dot_product_attention` only supports a cache with'
+            f' `KVLayout.BTHD`. Got: {self.kv_layout}'
+        )
+      if self.activation_dtype is not None:
+        query_scaled = query_scaled.astype(self.activation_dtype)
+      # The kernel requires query, key and value to share a dtype, while the
+      # cache can be stored in a different one.
+      key_proj = key_proj.astype(query_scaled.dtype)
+      value_proj = value_proj.astype(query_scaled.dtype)
+      # The query is already scaled by `query_pre_attn_scalar`.
+      encoded = jax.nn.dot_product_attention(
+          query_scaled,
+          key_proj,
           value_proj,
-          slice_indices,
+          mask=None
+          if attn_mask is None
+          else attn_mask[:, None, :, :].astype(jnp.bool_),
+          scale=1.0,
       )
-      key_proj = jax.lax.dynamic_update_slice(
-          cache['k'], key_proj, slice_indices
+    else:
+      encoded = self._attend(
+          query_scaled,
+          key_proj,
+          value_proj,
+          attn_mask,
+          kv_spec,
+          k_scale=k_scale,
+          v_scale=v_scale,
       )
+    attn_output = self.attn_vec_einsum('BTNH,NHD->BTD', encoded)
+
+    return new_cache, attn_output
 
+  def _attend(
+      self,
+      query_scaled: jax.Array,
+      key_proj: jax.Array,
+      value_proj: jax.Array,
+      attn_mask: jax.Array | None,
+      kv_spec: str,
+      *,
+      k_scale: jax.Array | None = None,
+      v_scale: jax.Array | None = None,
+  ) -> jax.Array:
+    """Computes `softmax(q @ k.T) @ v`, materializing the attention logits.
+
+    For an int8 cache, `key_proj` and `value_proj` are the int8 values, and
+    `k_scale` / `v_scale` their scales. The scales are constant along the
+    contracted head dim, so they are applied to the logits and the
+    probabilities rather than to the full cache.
+
+    Args:
+      query_scaled: Scaled query `[B, T, N, H]`.
+      key_proj: Keys, in `kv_spec` layout.
+      value_proj: Values, in `kv_spec` layout.
+      attn_mask: Attention mask `[B, T, S]` or None.
+      kv_spec: Einsum spec of the keys / values.
+      k_scale: Scale of the int8 keys, or None.
+      v_scale: Scale of the int8 values, or None.
+
+    Returns:
+      The attention output `[B, T, N, H]`.
+    """
     if self.use_gqa:
       # Reshape matrices to enable einsums over groups.
       b, t, kg, h = query_scaled.shape
       query_scaled = query_scaled.reshape(
           (b, t, self.num_kv_heads, int(kg / self.num_kv_heads), h)
       )
-      logits = jnp.einsum('BTKGH,BSKH->BTKGS', query_scaled, key_proj)
+      logits = layers.einsum(
+          f'BTKGH,{kv_spec}->BTKGS',
+          query_scaled,
+          key_proj,
+          compute_dtype=self.activation_dtype,
+      )
+      if k_scale is not None:
+        logits *= _kv_scale_to_logits(k_scale, kv_spec, grouped=True)
       b, t, k, g, s = logits.shape
       logits = logits.reshape((b, t, k * g, s))
     else:
-      logits = jnp.einsum('BTNH,BSNH->BTNS', query_scaled, key_proj)
+      logits = layers.einsum(
+          f'BTNH,{kv_spec.replace("K", "N")}->BTNS',
+          query_scaled,
+          key_proj,
+          compute_dtype=self.activation_dtype,
+      )
+      if k_scale is not None:
+        logits *= _kv_scale_to_logits(k_scale, kv_spec, grouped=False)
 
     if self.attn_logits_soft_cap is not None:
       logits = jnp.tanh(logits / self.attn_logits_soft_cap)
       logits = logits * self.attn_logits_soft_cap
 
-    if self.attn_type == AttentionType.LOCAL_SLIDING:
-      if self.sliding_window_size is None:
-        raise ValueError(
-            'Sliding_window_size must be set if Local Sliding attention type'
-        )
-      sliding_mask = _create_sliding_mask(
-          segment_pos,
-          end_index=cache['end_index'][0] if cache is not None else 0,
-          # Derive cache length from attn_mask shape in case cache is None
-          cache_len=attn_mask.shape[-1],
-          sliding_window_size=self.sliding_window_size,
-      )
-      attn_mask *= sliding_mask
-
-    padded_logits = jnp.where((jnp.expand_dims(attn_mask, -2)), logits, K_MASK)
-    probs = jax.nn.softmax(padded_logits, axis=-1).astype(key_proj.dtype)
+    if attn_mask is not None:
+      logits = jnp.where((jnp.expand_dims(attn_mask, -2)), logits, K_MASK)
+    probs = jax.nn.softmax(logits, axis=-1)
+    if v_scale is None:
+      probs = probs.astype(key_proj.dtype)
     if self.use_gqa:
       # Reshape matrices to enable einsums over groups.
       b, t, kg, h = probs.shape
       probs = probs.reshape(
           (b, t, self.num_kv_heads, int(kg / self.num_kv_heads), h)
       )
-      encoded = jnp.einsum('BTKGS,BSKH->BTKGH', probs, value_proj)
+      if v_scale is not None:
+        probs *= _kv_scale_to_logits(v_scale, kv_spec, grouped=True)
+      encoded = layers.einsum(
+          f'BTKGS,{kv_spec}->BTKGH',
+          probs,
+          value_proj,
+          compute_dtype=self.activation_dtype,
+      )
       b, t, k, g, h = encoded.shape
       encoded = encoded.reshape((b, t, k * g, h))
     else:
-      encoded = jnp.einsum('BTNS,BSNH->BTNH', probs, value_proj)
-    attn_output = self.attn_vec_einsum('BTNH,NHD->BTD', encoded)
-
-    if cache is not None:
-      new_cache = {
-          'v': value_proj,
-          'k': key_proj,
-          'end_index': cache['end_index'] + seq_len,
-      }
-    else:
-      new_cache = None
-
-    return new_cache, attn_output
+      if v_scale is not None:
+        probs *= _kv_scale_to_logits(v_scale, kv_spec, grouped=False)
+      encoded = layers.einsum(
+          f'BTNS,{kv_spec.replace("K", "N")}->BTNH',
+          probs,
+          value_proj,
+          compute_dtype=self.activation_dtype,
+      )
+    return encoded
 
   @classmethod
   def init_cache(
@@ -259,17 +465,39 @@ class Attention(nn.Module):
       head_dim: int,
       batch_size: int,
       dtype: jnp.dtype = jnp.bfloat16,
+      kv_layout: KVLayout = KVLayout.BTHD,
   ) -> LayerCache:
+    """Initializes the layer cache.
+
+    Args:
+      cache_size: Number of tokens to cache.
+      num_heads: Number of kv heads.
+      head_dim: Dimension of each head.
+      batch_size: Batch size.
+      dtype: Dtype of the `k` / `v` values. If `jnp.int8`, the cache is
+        quantized, and additional `k_scale` / `v_scale` float32 scales (one per
+        token and head) are stored.
+      kv_layout: Layout of the `k` / `v` arrays.
+
+    Returns:
+      The layer cache.
+    """
     del cls  # not used
-    return {
-        'v': jnp.zeros(
-            (batch_size, cache_size, num_heads, head_dim), dtype=dtype
-        ),
-        'k': jnp.zeros(
-            (batch_size, cache_size, num_heads, head_dim), dtype=dtype
-        ),
+    if kv_layout == KVLayout.BHDT:
+      shape = (batch_size, num_heads, head_dim, cache_size)
+      scale_shape = (batch_size, num_heads, 1, cache_size)
+    else:
+      shape = (batch_size, cache_size, num_heads, head_dim)
+      scale_shape = (batch_size, cache_size, num_heads, 1)
+    cache = {
+        'v': jnp.zeros(shape, dtype=dtype),
+        'k': jnp.zeros(shape, dtype=dtype),
         'end_index': jnp.zeros((batch_size,), dtype=jnp.int32),
     }
+    if jnp.dtype(dtype) == jnp.int8:
+      cache['v_scale'] = jnp.zeros(scale_shape, dtype=jnp.float32)
+      cache['k_scale'] = jnp.zeros(scale_shape, dtype=jnp.float32)
+    return cache
 
 
 class FeedForward(nn.Module):
@@ -278,6 +506,8 @@ class FeedForward(nn.Module):
   features: int
   hidden_dim: int
   transpose_gating_einsum: bool
+  # See `Attention.activation_dtype`.
+  activation_dtype: jnp.dtype | None = None
 
   @nn.compact
   def __call__(self, x):
@@ -288,12 +518,14 @@ class FeedForward(nn.Module):
       gating = layers.Einsum(
           shape=(2, self.hidden_dim, self.features),
           weight_name='gating_einsum',
+          compute_dtype=self.activation_dtype,
       )
     else:
       eq = '...F,NFH->...NH'
       gating = layers.Einsum(
           shape=(2, self.features, self.hidden_dim),
           weight_name='gating_einsum',
+          compute_dtype=self.activation_dtype,
       )
 
     # Use the same scope for backwards compatibility with existing checkpoints
@@ -306,6 +538,7 @@ class FeedForward(nn.Module):
     linear = layers.Einsum(
         shape=(self.hidden_dim, self.features),
         weight_name='linear',
+        compute_dtype=self.activation_dtype,
     )
     nn.share_scope(self, linear)
     outputs = linear('...H,HF->...F', activations)
@@ -331,6 +564,11 @@ class Block(nn.Module):
   attn_logits_soft_cap: float | None = None
   sliding_window_size: int | None = None
   use_qk_norm: bool = False
+  kv_layout: KVLayout = KVLayout.BTHD
+  use_dot_product_attention: bool = False
+  activation_dtype: jnp.dtype | None = None
+  # See `Attention.layer_idx`.
+  layer_idx: int | None = None
 
   def setup(self):
     self.pre_attention_norm = layers.RMSNorm()
@@ -346,6 +584,10 @@ class Block(nn.Module):
         attn_logits_soft_cap=self.attn_logits_soft_cap,
         sliding_window_size=self.sliding_window_size,
         use_qk_norm=self.use_qk_norm,
+        kv_layout=self.kv_layout,
+        use_dot_product_attention=self.use_dot_product_attention,
+        activation_dtype=self.activation_dtype,
+        layer_idx=self.layer_idx,
     )
     self.post_attention_norm = None
     if self.use_post_attn_norm:
@@ -356,6 +598,7 @@ class Block(nn.Module):
         features=self.embed_dim,
         hidden_dim=self.hidden_dim,
         transpose_gating_einsum=self.transpose_gating_einsum,
+        activation_dtype=self.activation_dtype,
     )
     self.post_ffw_norm = None
     if self.use_post_ffw_norm:
@@ -366,7 +609,7 @@ class Block(nn.Module):
       x: jax.Array,
       segment_pos: jax.Array,
       cache: LayerCache | None,
-      attn_mask: jax.Array,
+      attn_mask: jax.Array | None = None,
   ) -> tuple[LayerCache | None, jax.Array]:
     inputs_normalized = self.pre_attention_norm(x)
     cache, attn_output = self.attn(
@@ -14,6 +14,7 @@
 
 """Tests for transformer modules."""
 
+import functools
 import logging
 
 from absl.testing import absltest
@@ -25,6 +26,195 @@ import numpy as np
 
 
 _ATTN_TYPE = modules.AttentionType.GLOBAL
+_RNG = jax.random.PRNGKey(0)
+_SEGMENT_POS = jnp.array([[0]])
+
+
+@functools.lru_cache(maxsize=None)
+def _ones(shape: tuple[int, ...]) -> jax.Array:
+  """Returns a (cached) `jnp.ones(shape)` array, to avoid re-allocations."""
+  return jnp.ones(shape)
+
+
+def _assert_allclose_on_device(
+    actual: jax.Array,
+    desired: jax.Array,
+    *,
+    rtol: float = 0.0,
+    atol: float = 0.0,
+) -> None:
+  """Like `np.testing.assert_allclose`, but only transfers a bool to host."""
+  if actual.shape != desired.shape:
+    raise AssertionError(f'Shape mismatch: {actual.shape} != {desired.shape}')
+  if not jnp.allclose(actual, desired, rtol=rtol, atol=atol).item():
+    raise AssertionError(f'Arrays are not close:\n{actual}\n{desired}')
+
+
+@functools.partial(jax.jit, static_argnums=0)
+def _apply(module, params, *args):
+  """Jitted `module.apply`.
+
+  Modules are hashable, so each module configuration is only compiled once,
+  and re-used across calls and tests.
+  """
+  return module.apply(params, *args)
+
+
+@functools.lru_cache(maxsize=None)
+def _init_attn_params(
+    *,
+    num_heads: int,
+    num_kv_heads: int,
+    features: int,
+    head_dim: int,
+    batch_size: int,
+    cache_size: int,
+    kv_layout: modules.KVLayout = modules.KVLayout.BTHD,
+):
+  """Returns the `Attention` params for the given shapes (memoized).
+
+  The params do not depend on `query_pre_attn_scalar` nor `attn_type`, so are
+  shared between all the attention modules of the same shape. They should not
+  be mutated.
+  """
+  attn = modules.Attention(
+      num_heads=num_heads,
+      num_kv_heads=num_kv_heads,
+      features=features,
+      head_dim=head_dim,
+      attn_type=_ATTN_TYPE,
+      query_pre_attn_scalar=head_dim**-0.5,
+      kv_layout=kv_layout,
+  )
+  cache = modules.Attention.init_cache(
+      cache_size=cache_size,
+      num_heads=num_kv_heads,
+      head_dim=head_dim,
+      batch_size=batch_size,
+      dtype=jnp.float32,
+      kv_layout=kv_layout,
+  )
+  return attn.init(
+      _RNG,
+      _ones((batch_size, 1, features)),
+      _SEGMENT_POS,
+      cache,
+      _ones((batch_size, 1, cache_size)),
+  )
+
+
+@functools.lru_cache(maxsize=None)
+def _init_block(
+    *,
+    num_heads: int,
+    num_kv_heads: int,
+    embed_dim: int,
+    head_dim: int,
+    hidden_dim: int,
+    use_post_attn_norm: bool,
+    use_post_ffw_norm: bool,
+    batch_size: int,
+    cache_size: int,
+    attn_type: modules.AttentionType = _ATTN_TYPE,
+    kv_layout: modules.KVLayout = modules.KVLayout.BTHD,
+):
+  """Returns a `Block`, its params and an empty cache (memoized).
+
+  `Block.init` is only traced once per configuration. The returned params and
+  cache are shared between tests, so should not be mutated.
+  """
+  block = modules.Block(
+      num_heads=num_heads,
+      num_kv_heads=num_kv_heads,
+      embed_dim=embed_dim,
+      head_dim=head_dim,
+      hidden_dim=hidden_dim,
+      use_post_attn_norm=use_post_attn_norm,
+      use_post_ffw_norm=use_post_ffw_norm,
+      attn_type=attn_type,
+      query_pre_attn_scalar=head_dim**-0.5,
+      transpose_gating_einsum=False,
+      kv_layout=kv_layout,
+  )
+  cache = modules.Attention.init_cache(
+      cache_size=cache_size,
+      num_heads=num_kv_heads,
+      head_dim=head_dim,
+      batch_size=batch_size,
+      dtype=jnp.float32,
+      kv_layout=kv_layout,
+  )
+  params = block.init(
+      _RNG,
+      _ones((batch_size, 1, embed_dim)),
+      _SEGMENT_POS,
+      cache,
+      _ones((batch_size, 1, cache_size)),
+  )
+  return block, params, cache
+
+
+@functools.partial(jax.jit, static_argnums=(0, 1))
+def _dual_apply(module_a, module_b, params_a, params_b, *args):
+  """Applies two modules on the same inputs, in a single jitted call."""
+  return module_a.apply(params_a, *args), module_b.apply(params_b, *args)
+
+
+def _post_norm_block_outputs(
+    *,
+    use_post_attn_norm: bool,
+    use_post_ffw_norm: bool,
+    ones_mlp_params: bool = False,
+) -> tuple[jax.Array, jax.Array]:
+  """Returns the outputs of a minimal normed and unnormed `Block`.
+
+  The normed and unnormed blocks do not have the same params structure, so
+  cannot be batched in a single `vmap`. Instead, both blocks are applied in a
+  single jitted function, which is only compiled once per configuration.
+
+  Args:
+    use_post_attn_norm: Forwarded to the normed `Block`.
+    use_post_ffw_norm: Forwarded to the normed `Block`.
+    ones_mlp_params: If `True`, replace the mlp params by ones.
+
+  Returns:
+    The normed and unnormed block outputs.
+  """
+  batch_size = 1
+  cache_size = 1
+  embed_dim = 1
+  all_blocks = []
+  all_params = []
+  for normed in (True, False):
+    block, params, cache = _init_block(
+        num_heads=1,
+        num_kv_heads=1,
+        embed_dim=embed_dim,
+        head_dim=2,
+        hidden_dim=1,
+        use_post_attn_norm=normed and use_post_attn_norm,
+        use_post_ffw_norm=normed and use_post_ffw_norm,
+        batch_size=batch_size,
+        cache_size=cache_size,
+    )
+    if ones_mlp_params:
+      params = jax.tree.map(lambda x: x, params)  # Copy the shared params.
+      for param in ['gating_einsum', 'linear']:
+        params['params']['mlp'][param] = jnp.ones_like(
+            params['params']['mlp'][param]
+        )
+    all_blocks.append(block)
+    all_params.append(params)
+
+  (_, normed_output), (_, unnormed_output) = _dual_apply(
+      *all_blocks,
+      *all_params,
+      _ones((batch_size, 1, embed_dim)),
+      _SEGMENT_POS,
+      cache,
+      _ones((batch_size, 1, cache_size)),
+  )
+  return normed_output, unnormed_output
 
 
 class EmbedderTest(absltest.TestCase):
@@ -34,24 +224,24 @@ class EmbedderTest(absltest.TestCase):
     embed_dim = 4
     embedder = modules.Embedder(vocab_size=vocab_size, embed_dim=embed_dim)
     output = embedder.apply(
-        {'params': {'input_embedding': jnp.ones((vocab_size, embed_dim))}},
+        {'params': {'input_embedding': _ones((vocab_size, embed_dim))}},
         [2, 3],
         method=modules.Embedder.encode,
     )
     expected = [[2.0, 2.0, 2.0, 2.0], [2.0, 2.0, 2.0, 2.0]]
-    np.testing.assert_array_equal(output, jnp.array(expected))
+    _assert_allclose_on_device(output, jnp.asarray(expected))
 
   def test_decodes(self):
     vocab_size = 5
     embed_dim = 2
     embedder = modules.Embedder(vocab_size=vocab_size, embed_dim=embed_dim)
     output = embedder.apply(
-        {'params': {'input_embedding': jnp.ones((vocab_size, embed_dim))}},
+        {'params': {'input_embedding': _ones((vocab_size, embed_dim))}},
         jnp.array([1, 2]),
         method=modules.Embedder.decode,
     )
     expected = [3.0, 3.0, 3.0, 3.0, 3.0]
-    np.testing.assert_array_equal(output, jnp.array(expected))
+    _assert_allclose_on_device(output, jnp.asarray(expected))
 
 
 class SlidingWindowTest(absltest.TestCase):
@@ -153,7 +343,7 @@ class SlidingWindowTest(absltest.TestCase):
     )
 
 
-class AttentionTest(absltest.TestCase):
+class AttentionTest(parameterized.TestCase):
 
   def _get_attn_output(
       self,
@@ -162,11 +352,16 @@ class AttentionTest(absltest.TestCase):
       features: int,
       query_pre_attn_scalar: float | None = None,
       num_kv_heads: int | None = None,
+      kv_layout: modules.KVLayout = modules.KVLayout.BTHD,
+      cache_dtype: jnp.dtype = jnp.float32,
+      attn_type: modules.AttentionType = _ATTN_TYPE,
+      use_dot_product_attention: bool = False,
+      activation_dtype: jnp.dtype | None = None,
+      with_attn_mask: bool = True,
   ) -> tuple[jnp.ndarray, jnp.ndarray]:
-    segment_pos = 0
     cache_size = 3
     batch_size = 2
-    attn_mask = jnp.ones((batch_size, 1, cache_size))
+    attn_mask = _ones((batch_size, 1, cache_size))
     if query_pre_attn_scalar is None:
       query_pre_attn_scalar = head_dim**-0.5
     if num_kv_heads is None:
@@ -177,26 +372,38 @@ class AttentionTest(absltest.TestCase):
         num_kv_heads=num_kv_heads,
         features=features,
         head_dim=head_dim,
-        attn_type=_ATTN_TYPE,
+        attn_type=attn_type,
         query_pre_attn_scalar=query_pre_attn_scalar,
+        sliding_window_size=2,
+        kv_layout=kv_layout,
+        use_dot_product_attention=use_dot_product_attention,
+        activation_dtype=activation_dtype,
     )
     cache = modules.Attention.init_cache(
         cache_size=cache_size,
         num_heads=num_kv_heads,
         head_dim=head_dim,
         batch_size=batch_size,
-        dtype=jnp.float32,
+        dtype=cache_dtype,
+        kv_layout=kv_layout,
+    )
+    x = _ones((batch_size, 1, features))
+    params = _init_attn_params(
+        num_heads=num_heads,
+        num_kv_heads=num_kv_heads,
+        features=features,
+        head_dim=head_dim,
+        batch_size=batch_size,
+        cache_size=cache_size,
+        kv_layout=kv_layout,
     )
-    x = jnp.ones((batch_size, 1, features))
-    params = attn.init(
-        jax.random.PRNGKey(0),
+    cache, output = _apply(
+        attn,
+        params,
         x,
-        jnp.array([[segment_pos]]),
+        _SEGMENT_POS,
         cache,
-        attn_mask,
-    )
-    cache, output = attn.apply(
-        params, x, jnp.array([[segment_pos]]), cache, attn_mask
+        attn_mask if with_attn_mask else None,
     )
     return cache, output
 
@@ -209,6 +416,8 @@ class AttentionTest(absltest.TestCase):
     expected_cache_shape = (2, 3, 2, 4)
     expected_output_shape = (2, 1, 8)
     self.assertEqual(cache['k'].shape, expected_cache_shape)
+    self.assertEqual(cache['k'].dtype, jnp.float32)
+    self.assertNotIn('k_scale', cache)
     self.assertEqual(output.shape, expected_output_shape)
 
   def test_attention_with_gqa(self):
@@ -223,52 +432,329 @@ class AttentionTest(absltest.TestCase):
     self.assertEqual(cache['k'].shape, expected_cache_shape)
     self.assertEqual(output.shape, expected_output_shape)
 
-  def test_sliding_window(self):
-    num_heads = 2
-    head_dim = 4
-    features = 8
-    segment_pos = 0
+  def test_attention_with_mqa(self):
+    cache, output = self._get_attn_output(
+        num_heads=4,
+        head_dim=2,
+        features=10,
+        num_kv_heads=1,
+    )
+    expected_cache_shape = (2, 3, 1, 2)
+    expected_output_shape = (2, 1, 10)
+    self.assertEqual(cache['k'].shape, expected_cache_shape)
+    self.assertEqual(output.shape, expected_output_shape)
+
+  def test_grouped_attention_matches_repeated_kv_heads(self):
+    num_heads = 4
+    head_dim = 2
+    features = 10
     cache_size = 3
     batch_size = 2
-    query_pre_attn_scalar = head_dim**-0.5
-    attn_mask = jnp.ones((batch_size, 1, cache_size))
-    cache = modules.Attention.init_cache(
-        cache_size=cache_size,
+    x = _ones((batch_size, 1, features))
+    attn_mask = _ones((batch_size, 1, cache_size))
+    for num_kv_heads in (1, 2):  # MQA and GQA
+      attn = modules.Attention(
+          num_heads=num_heads,
+          num_kv_heads=num_kv_heads,
+          features=features,
+          head_dim=head_dim,
+          attn_type=_ATTN_TYPE,
+          query_pre_attn_scalar=head_dim**-0.5,
+      )
+      params = _init_attn_params(
+          num_heads=num_heads,
+          num_kv_heads=num_kv_heads,
+          features=features,
+          head_dim=head_dim,
+          batch_size=batch_size,
+          cache_size=cache_size,
+      )['params']
+      cache = modules.Attention.init_cache(
+          cache_size=cache_size,
+          num_heads=num_kv_heads,
+          head_dim=head_dim,
+          batch_size=batch_size,
+          dtype=jnp.float32,
+      )
+      _, output = _apply(
+          attn, {'params': params}, x, _SEGMENT_POS, cache, attn_mask
+      )
+
+      # Equivalent MHA, where each kv head is repeated for all the query heads
+      # of its group.
+      mha_attn = modules.Attention(
+          num_heads=num_heads,
+          num_kv_heads=num_heads,
+          features=features,
+          head_dim=head_dim,
+          attn_type=_ATTN_TYPE,
+          query_pre_attn_scalar=head_dim**-0.5,
+      )
+      kv_w = jnp.repeat(
+          params['kv_einsum']['w'], num_heads // num_kv_heads, axis=1
+      )
+      mha_params = {
+          'qkv_einsum': {
+              'w': jnp.concatenate(
+                  [params['q_einsum']['w'][None], kv_w], axis=0
+              )
+          },
+          'attn_vec_einsum': params['attn_vec_einsum'],
+      }
+      mha_cache = modules.Attention.init_cache(
+          cache_size=cache_size,
+          num_heads=num_heads,
+          head_dim=head_dim,
+          batch_size=batch_size,
+          dtype=jnp.float32,
+      )
+      _, mha_output = _apply(
+          mha_attn,
+          {'params': mha_params},
+          x,
+          _SEGMENT_POS,
+          mha_cache,
+          attn_mask,
+      )
+      _assert_allclose_on_device(output, mha_output, rtol=1e-5, atol=1e-6)
+
+  def test_attention_projection_params(self):
+    # Without GQA, the q, k, v projections are fused in a single einsum.
+    params = _init_attn_params(
+        num_heads=2,
+        num_kv_heads=2,
+        features=8,
+        head_dim=4,
+        batch_size=2,
+        cache_size=3,
+    )['params']
+    self.assertCountEqual(params, ['qkv_einsum', 'attn_vec_einsum'])
+    self.assertEqual(params['qkv_einsum']['w'].shape, (3, 2, 8, 4))
+
+    # With GQA, the k and v projections are still fused together.
+    params = _init_attn_params(
+        num_heads=8,
+        num_kv_heads=4,
+        features=10,
+        head_dim=2,
+        batch_size=2,
+        cache_size=3,
+    )['params']
+    self.assertCountEqual(params, ['q_einsum', 'kv_einsum', 'attn_vec_einsum'])
+    self.assertEqual(params['q_einsum']['w'].shape, (8, 10, 2))
+    self.assertEqual(params['kv_einsum']['w'].shape, (2, 4, 10, 2))
+
+  @parameterized.parameters(
+      dict(num_heads=2, num_kv_heads=2),
+      dict(num_heads=8, num_kv_heads=4),
+  )
+  def test_attention_bhdt_kv_layout(self, num_heads: int, num_kv_heads: int):
+    _, output = self._get_attn_output(
         num_heads=num_heads,
-        head_dim=head_dim,
-        batch_size=batch_size,
-        dtype=jnp.float32,
+        head_dim=4,
+        features=8,
+        num_kv_heads=num_kv_heads,
     )
-    x = jnp.ones((batch_size, 1, features))
-    attn = modules.Attention(
+    cache, bhdt_output = self._get_attn_output(
         num_heads=num_heads,
-        num_kv_heads=num_heads,
-        features=features,
-        head_dim=head_dim,
-        attn_type=_ATTN_TYPE,
-        query_pre_attn_scalar=query_pre_attn_scalar,
+        head_dim=4,
+        features=8,
+        num_kv_heads=num_kv_heads,
+        kv_layout=modules.KVLayout.BHDT,
     )
-    params = attn.init(
-        jax.random.PRNGKey(0),
-        x,
-        jnp.array([[segment_pos]]),
-        cache,
-        attn_mask,
+    expected_cache_shape = (2, num_kv_heads, 4, 3)
+    self.assertEqual(cache['k'].shape, expected_cache_shape)
+    self.assertEqual(cache['v'].shape, expected_cache_shape)
+    np.testing.assert_array_almost_equal(output, bhdt_output)
+
+  @parameterized.parameters(
+      dict(
+          num_heads=8,
+          num_kv_heads=4,
+          kv_layout=modules.KVLayout.BTHD,
+          expected_scale_shape=(2, 3, 4, 1),
+      ),
+      dict(
+          num_heads=8,
+          num_kv_heads=4,
+          kv_layout=modules.KVLayout.BHDT,
+          expected_scale_shape=(2, 4, 1, 3),
+      ),
+      dict(
+          num_heads=4,
+          num_kv_heads=4,
+          kv_layout=modules.KVLayout.BTHD,
+          expected_scale_shape=(2, 3, 4, 1),
+      ),
+      dict(
+          num_heads=4,
+          num_kv_heads=1,
+          kv_layout=modules.KVLayout.BHDT,
+          expected_scale_shape=(2, 1, 1, 3),
+      ),
+  )
+  def test_attention_int8_kv_cache(
+      self,
+      num_heads: int,
+      num_kv_heads: int,
+      kv_layout: modules.KVLayout,
+      expected_scale_shape: tuple[int, ...],
+  ):
+    kwargs = dict(
+        num_heads=num_heads,
+        head_dim=2,
+        features=10,
+        num_kv_heads=num_kv_heads,
+        kv_layout=kv_layout,
+    )
+    _, output = self._get_attn_output(**kwargs)
+    cache, int8_output = self._get_attn_output(**kwargs, cache_dtype=jnp.int8)
+    self.assertEqual(cache['k'].dtype, jnp.int8)
+    self.assertEqual(cache['v'].dtype, jnp.int8)
+    self.assertEqual(cache['k_scale'].dtype, jnp.float32)
+    self.assertEqual(cache['k_scale'].shape, expected_scale_shape)
+    self.assertEqual(cache['v_scale'].shape, expected_scale_shape)
+    _assert_allclose_on_device(output, int8_output, atol=1e-2)
+
+  def test_dot_product_attention_rejects_int8_kv_cache(self):
+    with self.assertRaisesRegex(ValueError, 'does not support an int8 cache'):
+      self._get_attn_output(
+          num_heads=2,
+          head_dim=4,
+          features=8,
+          cache_dtype=jnp.int8,
+          use_dot_product_attention=True,
+      )
+
+  @parameterized.parameters(
+      dict(num_heads=2, num_kv_heads=2),
+      dict(num_heads=8, num_kv_heads=4),
+      dict(
+          num_heads=2,
+          num_kv_heads=2,
+          attn_type=modules.AttentionType.LOCAL_SLIDING,
+      ),
+      # The cache dtype differs from the float32 activations.
+      dict(num_heads=8, num_kv_heads=4, cache_dtype=jnp.bfloat16),
+  )
+  def test_dot_product_attention(
+      self,
+      num_heads: int,
+      num_kv_heads: int,
+      attn_type: modules.AttentionType = _ATTN_TYPE,
+      cache_dtype: jnp.dtype = jnp.float32,
+  ):
+    kwargs = dict(
+        num_heads=num_heads,
+        head_dim=4,
+        features=8,
+        num_kv_heads=num_kv_heads,
+        cache_dtype=cache_dtype,
+        attn_type=attn_type,
+    )
+    cache, output = self._get_attn_output(**kwargs)
+    fused_cache, fused_output = self._get_attn_output(
+        **kwargs, use_dot_product_attention=True
+    )
+    self.assertEqual(fused_output.dtype, output.dtype)
+    _assert_allclose_on_device(output, fused_output, rtol=1e-5, atol=1e-5)
+    np.testing.assert_array_equal(cache['k'], fused_cache['k'])
+
+  def test_dot_product_attention_bhdt_kv_layout_without_cache(self):
+    # Without cache, `kv_layout` is unused, so the fused path supports it.
+    outputs = []
+    for kv_layout in (modules.KVLayout.BTHD, modules.KVLayout.BHDT):
+      attn = modules.Attention(
+          num_heads=2,
+          num_kv_heads=2,
+          features=8,
+          head_dim=4,
+          attn_type=_ATTN_TYPE,
+          query_pre_attn_scalar=4**-0.5,
+          kv_layout=kv_layout,
+          use_dot_product_attention=True,
+      )
+      params = _init_attn_params(
+          num_heads=2,
+          num_kv_heads=2,
+          features=8,
+          head_dim=4,
+          batch_size=2,
+          cache_size=3,
+      )
+      cache, output = _apply(
+          attn, params, _ones((2, 1, 8)), _SEGMENT_POS, None, _ones((2, 1, 1))
+      )
+      self.assertIsNone(cache)
+      outputs.append(output)
+    _assert_allclose_on_device(*outputs)
+
+  def test_dot_product_attention_rejects_bhdt_kv_layout(self):
+    with self.assertRaisesRegex(ValueError, 'only supports a cache with'):
+      self._get_attn_output(
+          num_heads=2,
+          head_dim=4,
+          features=8,
+          kv_layout=modules.KVLayout.BHDT,
+          use_dot_product_attention=True,
+      )
+
+  @parameterized.parameters(
+      dict(num_heads=2, num_kv_heads=2),
+      dict(num_heads=8, num_kv_heads=4),
+  )
+  def test_bf16_attention(self, num_heads: int, num_kv_heads: int):
+    kwargs = dict(
+        num_heads=num_heads,
+        head_dim=4,
+        features=8,
+        num_kv_heads=num_kv_heads,
     )
-    _, output = attn.apply(
-        params, x, jnp.array([[segment_pos]]), cache, attn_mask
+    _, output = self._get_attn_output(**kwargs)
+    _, bf16_output = self._get_attn_output(
+        **kwargs, activation_dtype=jnp.bfloat16
     )
-    sliding_attn = modules.Attention(
-        num_heads=num_heads,
-        num_kv_heads=num_heads,
-        features=features,
-        head_dim=head_dim,
-        attn_type=modules.AttentionType.LOCAL_SLIDING,
-        sliding_window_size=2,
-        query_pre_attn_scalar=query_pre_attn_scalar,
+    # Accumulation is done in float32.
+    self.assertEqual(bf16_output.dtype, jnp.float32)
+    _assert_allclose_on_device(output, bf16_output, atol=1e-2)
+
+  @parameterized.parameters(
+      dict(attn_type=_ATTN_TYPE, use_dot_product_attention=False),
+      dict(attn_type=_ATTN_TYPE, use_dot_product_attention=True),
+      dict(
+          attn_type=modules.AttentionType.LOCAL_SLIDING,
+          use_dot_product_attention=False,
+      ),
+  )
+  def test_attention_no_mask(
+      self,
+      attn_type: modules.AttentionType,
+      use_dot_product_attention: bool,
+  ):
+    kwargs = dict(
+        num_heads=2,
+        head_dim=4,
+        features=8,
+        attn_type=attn_type,
+        use_dot_product_attention=use_dot_product_attention,
+    )
+    _, output = self._get_attn_output(**kwargs)
+    _, no_mask_output = self._get_attn_output(**kwargs, with_attn_mask=False)
+    _assert_allclose_on_device(output, no_mask_output, rtol=1e-6)
+
+  def test_sliding_window(self):
+    # Both attention modules have the same shapes, so share the same
+    # (memoized) params.
+    _, output = self._get_attn_output(
+        num_heads=2,
+        head_dim=4,
+        features=8,
     )
-    _, sliding_output = sliding_attn.apply(
-        params, x, jnp.array([[segment_pos]]), cache, attn_mask
+    _, sliding_output = self._get_attn_output(
+        num_heads=2,
+        head_dim=4,
+        features=8,
+        attn_type=modules.AttentionType.LOCAL_SLIDING,
     )
 
     self.assertFalse((output == sliding_output).all())
@@ -309,29 +795,64 @@ class FeedForwardTest(parameterized.TestCase):
     features = 2
     hidden_dim = 3
     batch_size = 2
-    inputs = jnp.arange(1, batch_size + 1)[:, None, None]
-    inputs = jnp.repeat(inputs, features, axis=-1)
+    # `[B, 1, 1]`, broadcast by the einsum against the `features` axis.
+    inputs = jnp.arange(1, batch_size + 1, dtype=jnp.float32)[:, None, None]
     ffw = modules.FeedForward(
         features=features,
         hidden_dim=hidden_dim,
         transpose_gating_einsum=transpose_gating_einsum,
     )
 
-    params = {'linear': jnp.ones((hidden_dim, features))}
+    params = {'linear': _ones((hidden_dim, features))}
 
     # Different checkpoints have params saved in different order
     if transpose_gating_einsum:
-      params['gating_einsum'] = jnp.ones((batch_size, hidden_dim, features))
+      params['gating_einsum'] = _ones((batch_size, hidden_dim, features))
     else:
-      params['gating_einsum'] = jnp.ones((batch_size, features, hidden_dim))
+      params['gating_einsum'] = _ones((batch_size, features, hidden_dim))
 
-    outputs = ffw.apply({'params': params}, inputs)
+    outputs = _apply(ffw, {'params': params}, inputs)
 
     expected_val = [11.72758674, 47.99916]
     expected_shape = (2, 1, 2)
-    np.testing.assert_array_almost_equal(outputs[:, 0, 0], expected_val)
+    _assert_allclose_on_device(
+        outputs[:, 0, 0], jnp.asarray(expected_val), atol=1e-5
+    )
     self.assertEqual(outputs.shape, expected_shape)
 
+  @parameterized.parameters(
+      dict(
+          transpose_gating_einsum=False,
+      ),
+      dict(
+          transpose_gating_einsum=True,
+      ),
+  )
+  def test_bf16_ffw(self, transpose_gating_einsum: bool):
+    features = 2
+    hidden_dim = 3
+    batch_size = 2
+    inputs = jnp.arange(1, batch_size + 1, dtype=jnp.float32)[:, None, None]
+    ffw = modules.FeedForward(
+        features=features,
+        hidden_dim=hidden_dim,
+        transpose_gating_einsum=transpose_gating_einsum,
+    )
+    bf16_ffw = modules.FeedForward(
+        features=features,
+        hidden_dim=hidden_dim,
+        transpose_gating_einsum=transpose_gating_einsum,
+        activation_dtype=jnp.bfloat16,
+    )
+    params = ffw.init(_RNG, inputs)
+
+    outputs = _apply(ffw, params, inputs)
+    bf16_outputs = _apply(bf16_ffw, params, inputs)
+
+    # Accumulation is done in float32.
+    self.assertEqual(bf16_outputs.dtype, jnp.float32)
+    _assert_allclose_on_device(outputs, bf16_outputs, rtol=1e-2, atol=1e-2)
+
   @parameterized.parameters(
       dict(
           transpose_gating_einsum=False,
@@ -347,18 +868,17 @@ class FeedForwardTest(parameterized.TestCase):
     features = 2
     hidden_dim = 3
     batch_size = 2
-    inputs = jnp.arange(1, batch_size + 1)[:, None, None]
-    inputs = jnp.repeat(inputs, features, axis=-1)
+    inputs = jnp.arange(1, batch_size + 1, dtype=jnp.float32)[:, None, None]
     ffw = modules.FeedForward(
         features=features,
         hidden_dim=hidden_dim,
         transpose_gating_einsum=transpose_gating_einsum,
     )
     loss = lambda params, inputs: jnp.square(
-        ffw.apply(params, inputs) - jnp.ones((batch_size, 1, features))
+        ffw.apply(params, inputs) - _ones((batch_size, 1, features))
     ).mean()
 
-    params = ffw.init(jax.random.PRNGKey(0), inputs)
+    params = ffw.init(_RNG, inputs)
 
     grad_loss = jax.grad(loss)
     grad = grad_loss(params, inputs)
@@ -367,38 +887,25 @@ class FeedForwardTest(parameterized.TestCase):
 class BlockTest(absltest.TestCase):
 
   def test_block(self):
-    num_heads = 2
-    embed_dim = 4
-    head_dim = 6
-    cache_size = 3
     batch_size = 2
-    inputs = jnp.ones((batch_size, 1, embed_dim))
-    cache = modules.Attention.init_cache(
-        cache_size=cache_size,
-        num_heads=num_heads,
-        head_dim=head_dim,
-        batch_size=batch_size,
-        dtype=jnp.float32,
-    )
-    attn_mask = jnp.ones((batch_size, 1, cache_size))
-    block = modules.Block(
-        num_heads=num_heads,
-        num_kv_heads=num_heads,
+    cache_size = 3
+    embed_dim = 4
+    block, params, cache = _init_block(
+        num_heads=2,
+        num_kv_heads=2,
         embed_dim=embed_dim,
-        head_dim=head_dim,
+        head_dim=6,
         hidden_dim=1,
         use_post_attn_norm=False,
         use_post_ffw_norm=False,
-        attn_type=_ATTN_TYPE,
-        query_pre_attn_scalar=head_dim**-0.5,
-        transpose_gating_einsum=False,
-    )
-    params = block.init(
-        jax.random.PRNGKey(0), inputs, jnp.array([[0]]), cache, attn_mask
+        batch_size=batch_size,
+        cache_size=cache_size,
     )
+    inputs = _ones((batch_size, 1, embed_dim))
+    attn_mask = _ones((batch_size, 1, cache_size))
 
-    new_cache, outputs = block.apply(
-        params, inputs, jnp.array([[0]]), cache, attn_mask
+    new_cache, outputs = _apply(
+        block, params, inputs, _SEGMENT_POS, cache, attn_mask
     )
 
     expected_cache_shape = (2, 3, 2, 6)
@@ -406,135 +913,62 @@ class BlockTest(absltest.TestCase):
     self.assertEqual(new_cache['k'].shape, expected_cache_shape)
     self.assertEqual(outputs.shape, expected_output_shape)
 
-  def test_post_attention_norm_modifies_output(self):
-    num_heads = 1
-    embed_dim = 1
-    head_dim = 2
-    hidden_dim = 1
-    cache_size = 1
-    batch_size = 1
-    query_pre_attn_scalar = head_dim**-0.5
-    inputs = jnp.ones((batch_size, 1, embed_dim))
-    cache = modules.Attention.init_cache(
-        cache_size=cache_size,
-        num_heads=num_heads,
-        head_dim=head_dim,
-        batch_size=batch_size,
-        dtype=jnp.float32,
-    )
-    attn_mask = jnp.ones((batch_size, 1, cache_size))
-    normed_block = modules.Block(
-        num_heads=num_heads,
-        num_kv_heads=num_heads,
-        embed_dim=embed_dim,
-        head_dim=head_dim,
-        hidden_dim=hidden_dim,
-        use_post_attn_norm=True,
-        use_post_ffw_norm=False,
-        attn_type=_ATTN_TYPE,
-        query_pre_attn_scalar=query_pre_attn_scalar,
-        transpose_gating_einsum=False,
-    )
-    unnormed_block = modules.Block(
-        num_heads=num_heads,
-        num_kv_heads=num_heads,
+  def test_block_bhdt_kv_layout(self):
+    batch_size = 2
+    cache_size = 3
+    embed_dim = 4
+    block, params, cache = _init_block(
+        num_heads=2,
+        num_kv_heads=2,
         embed_dim=embed_dim,
-        head_dim=head_dim,
-        hidden_dim=hidden_dim,
+        head_dim=6,
+        hidden_dim=1,
         use_post_attn_norm=False,
         use_post_ffw_norm=False,
-        attn_type=_ATTN_TYPE,
-        query_pre_attn_scalar=query_pre_attn_scalar,
-        transpose_gating_einsum=False,
+        batch_size=batch_size,
+        cache_size=cache_size,
+        kv_layout=modules.KVLayout.BHDT,
     )
+    inputs = _ones((batch_size, 1, embed_dim))
+    attn_mask = _ones((batch_size, 1, cache_size))
 
-    all_outputs = []
-    for block in (normed_block, unnormed_block):
-      params = block.init(
-          jax.random.PRNGKey(0), inputs, jnp.array([[0]]), cache, attn_mask
-      )
+    new_cache, outputs = _apply(
+        block, params, inputs, _SEGMENT_POS, cache, attn_mask
+    )
 
-      _, outputs = block.apply(
-          params, inputs, jnp.array([[0]]), cache, attn_mask
-      )
-      all_outputs.append(outputs)
+    expected_cache_shape = (2, 2, 6, 3)
+    expected_output_shape = (2, 1, 4)
+    self.assertEqual(new_cache['k'].shape, expected_cache_shape)
+    self.assertEqual(outputs.shape, expected_output_shape)
 
-    normed_output, unnormed_output = all_outputs  # pylint: disable=unbalanced-tuple-unpacking
+  def test_post_attention_norm_modifies_output(self):
+    normed_output, unnormed_output = _post_norm_block_outputs(
+        use_post_attn_norm=True,
+        use_post_ffw_norm=False,
+    )
     logging.info('normed_output: %s', normed_output)
     logging.info('unnormed_output: %s', unnormed_output)
 
     # Normed and unnormed outputs should not be equal.
-    with np.testing.assert_raises(AssertionError):
-      np.testing.assert_array_almost_equal(normed_output, unnormed_output)
+    self.assertFalse(
+        jnp.allclose(normed_output, unnormed_output, rtol=0, atol=1.5e-6).item()
+    )
 
   def test_post_ffw_norm_modifies_output(self):
-    num_heads = 1
-    embed_dim = 1
-    head_dim = 2
-    hidden_dim = 1
-    cache_size = 1
-    batch_size = 1
-    query_pre_attn_scalar = head_dim**-0.5
-    inputs = jnp.ones((batch_size, 1, embed_dim))
-    cache = modules.Attention.init_cache(
-        cache_size=cache_size,
-        num_heads=num_heads,
-        head_dim=head_dim,
-        batch_size=batch_size,
-        dtype=jnp.float32,
-    )
-    attn_mask = jnp.ones((batch_size, 1, cache_size))
-    normed_block = modules.Block(
-        num_heads=num_heads,
-        num_kv_heads=num_heads,
-        embed_dim=embed_dim,
-        head_dim=head_dim,
-        hidden_dim=hidden_dim,
+    # Replace mlp block params with 1s as ffw will initialize with
+    # 0s which will not properly test normalization.
+    normed_output, unnormed_output = _post_norm_block_outputs(
         use_post_attn_norm=False,
         use_post_ffw_norm=True,
-        attn_type=_ATTN_TYPE,
-        query_pre_attn_scalar=query_pre_attn_scalar,
-        transpose_gating_einsum=False,
+        ones_mlp_params=True,
     )
-    unnormed_block = modules.Block(
-        num_heads=num_heads,
-        num_kv_heads=num_heads,
-        embed_dim=embed_dim,
-        head_dim=head_dim,
-        hidden_dim=hidden_dim,
-        use_post_attn_norm=False,
-        use_post_ffw_norm=False,
-        attn_type=_ATTN_TYPE,
-        query_pre_attn_scalar=query_pre_attn_scalar,
-        transpose_gating_einsum=False,
-    )
-
-    all_outputs = []
-    for block in (normed_block, unnormed_block):
-
-      params = block.init(
-          jax.random.PRNGKey(0), inputs, jnp.array([[0]]), cache, attn_mask
-      )
-
-      # Replace mlp block params with 1s as ffw will initialize with
-      # 0s which will not properly test normalization.
-      for param in ['gating_einsum', 'linear']:
-        params['params']['mlp'][param] = jnp.ones_like(
-            params['params']['mlp'][param]
-        )
-
-      _, outputs = block.apply(
-          params, inputs, jnp.array([[0]]), cache, attn_mask
-      )
-      all_outputs.append(outputs)
-
-    normed_output, unnormed_output = all_outputs  # pylint: disable=unbalanced-tuple-unpacking
     logging.info('normed_output: %s', normed_output)
     logging.info('unnormed_output: %s', unnormed_output)
 
     # Normed and unnormed outputs should not be equal.
-    with np.testing.assert_raises(AssertionError):
-      np.testing.assert_array_almost_equal(normed_output, unnormed_output)
+    self.assertFalse(
+        jnp.allclose(normed_output, unnormed_output, rtol=0, atol=1.5e-6).item()
+    )
 
 
 if __name__ == '__main__':
@@ -31,6 +31,9 @@ import jax
 import jax.numpy as jnp
 
 Cache = dict[str, modules.LayerCache]
+# Cache of a `use_stacked_cache=True` config: the same entries as a
+# `LayerCache`, with an extra `num_layers` axis after the batch axis.
+StackedCache = modules.LayerCache
 
 
 def make_attention_layers_types(
@@ -108,6 +111,14 @@ class TransformerConfig:
   global_scale_factor: float = modules.DEFAULT_ROPE_SCALE_FACTOR
   mm_extra_vocab_size: int = 0
   vision_encoder: gemma_vision.SigLiPFromPatches | None = None
+  # If `True`, the attention uses the fused `jax.nn.dot_product_attention`
+  # kernel (not compatible with `attn_logits_soft_cap`).
+  use_dot_product_attention: bool = False
+  # If `True`, `init_cache()` allocates each cache entry once for all layers
+  # (e.g. `k` is `[B, num_layers, cache_length, num_kv_heads, head_dim]`),
+  # rather than one cache per layer. Each block then only writes its new
+  # tokens into its slice of the shared buffers.
+  use_stacked_cache: bool = False
 
   def query_pre_attn_scalar(self) -> float:
     """Returns the scalar to multiply the query by before attention."""
@@ -383,13 +394,29 @@ class TransformerConfig:
       dtype: jnp.dtype = jnp.bfloat16,
       *,
       cache_length: int | None = None,
-  ) -> Cache:
+  ) -> Cache | StackedCache:
     """Initializes a new Transformer cache."""
     cache_length = cache_length or self.max_cache_length
     if cache_length is None:
       raise ValueError(
           'Missing `cache_length=` kwarg when calling `init_cache()`.'
       )
+    if self.use_stacked_cache:
+      layer_cache = jax.eval_shape(
+          lambda: modules.Attention.init_cache(
+              cache_length,
+              self.num_kv_heads,
+              self.head_dim,
+              batch_size,
+              dtype,
+          )
+      )
+      return jax.tree.map(
+          lambda x: jnp.zeros(
+              (x.shape[0], self.num_layers, *x.shape[1:]), x.dtype
+          ),
+          layer_cache,
+      )
     cache = {
         f'layer_{i}': modules.Attention.init_cache(
             cache_length,
@@ -450,6 +477,8 @@ class Transformer(nn.Module):
             rope_scale_factor=self.config.local_scale_factor
             if attn_type == modules.AttentionType.LOCAL_SLIDING
             else self.config.global_scale_factor,
+            use_dot_product_attention=self.config.use_dot_product_attention,
+            layer_idx=i if self.config.use_stacked_cache else None,
         )
         for i, attn_type in zip(
             range(self.config.num_layers), self.config.attention_types
@@ -463,10 +492,10 @@ class Transformer(nn.Module):
       self,
       last_tokens: jax.Array,  # [B, L]
       positions: jax.Array,  # [B, L]
-      cache: Cache | None,  # (sequence length L')
+      cache: Cache | StackedCache | None,  # (sequence length L')
       attention_mask: jax.Array,  # [B, L, L']
       patches: jax.Array | None = None,  # [B, N, P, D']
-  ) -> tuple[jax.Array, Cache | None]:
+  ) -> tuple[jax.Array, Cache | StackedCache | None]:
     """Transformer forward pass.
 
     You can run this forward pass two ways: with or without an attention kv
@@ -493,6 +522,10 @@ class Transformer(nn.Module):
           last_tokens=last_tokens, embeddings=x, patches=patches
       )
     for i, block in enumerate(self.blocks):
+      if self.config.use_stacked_cache:
+        # Each block updates its own slice of the stacked cache.
+        cache, x = block(x, positions, cache, attention_mask)
+        continue
       layer_name = f'layer_{i}'
       layer_cache = cache[layer_name] if cache else None
       layer_cache, x = block(